@@ -1,117 +1,256 @@
+import asyncio
+import logging
 import os
+import re
+import sys
 import time
-from typing import Dict
-import requests
+from collections import OrderedDict
+from typing import Dict, Tuple
+import httpx
+import orjson
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
+from starlette.routing import Match
+from pydantic import BaseModel, ConfigDict
 
-from database import get_documents
+from database import aggregate_documents, ensure_indexes
 
 COUNTRIES = {
     "NL": {"code": "NL", "name": "Nederland"},
     "AE": {"code": "AE", "name": "Dubai"},
     "BH": {"code": "BH", "name": "Bahrein"},
 }
+_COUNTRIES_LIST = list(COUNTRIES.values())
+_COUNTRIES_JSON = orjson.dumps(_COUNTRIES_LIST)
+_ROOT_JSON = orjson.dumps({"message": "BirthdayDeals Backend Running"})
+_HEALTH_JSON = orjson.dumps({"status": "ok", "countries": _COUNTRIES_LIST})
+_COUNTRY_LOOKUP = {c: c for c in COUNTRIES} | {c.lower(): c for c in COUNTRIES}
 
-app = FastAPI(title="BirthdayDeals API")
+logger = logging.getLogger(__name__)
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+app = FastAPI(title="BirthdayDeals API", default_response_class=ORJSONResponse)
+
+# Shared outbound HTTP client (keep-alive pooled, non-blocking)
+_http = httpx.AsyncClient(
+    timeout=httpx.Timeout(5.0, connect=2.0),
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
 )
 
-# Simple in-process rate limiting (per IP per route)
-RateKey = str
-_rate_store: Dict[RateKey, Dict[str, float]] = {}
-
-def check_rate_limit(request: Request, limit: int, window_seconds: int) -> bool:
-    ip = request.client.host if request.client else "unknown"
-    path = request.url.path
-    key = f"{ip}:{path}:{window_seconds}"
-    now = time.time()
-    entry = _rate_store.get(key)
-    if not entry:
-        _rate_store[key] = {"count": 1, "reset": now + window_seconds}
-        return True
-    if now > entry["reset"]:
-        _rate_store[key] = {"count": 1, "reset": now + window_seconds}
+async def _ensure_indexes_background():
+    try:
+        await ensure_indexes()
+    except Exception as e:
+        logger.warning("Could not ensure database indexes: %s", e)
+
+_index_task = None
+
+@app.on_event("startup")
+async def create_indexes():
+    # Run in the background so an unreachable Mongo doesn't hold up startup
+    # for the server selection timeout; /test reports the database status
+    global _index_task
+    _index_task = asyncio.create_task(_ensure_indexes_background())
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await _http.aclose()
+
+# Simple in-process rate limiting (per IP per route, token bucket)
+RateKey = Tuple[str, str, int]
+
+class _Bucket:
+    __slots__ = ("t", "ts")
+
+    def __init__(self, t: float, ts: float):
+        self.t = t
+        self.ts = ts
+
+_RATE_STORE_MAX = 100_000
+_RATE_SWEEP_INTERVAL = 60
+_rate_store: "OrderedDict[RateKey, _Bucket]" = OrderedDict()
+
+def _client_ip(request: Request) -> str:
+    # Behind a proxy, uvicorn's proxy_headers resolves client.host from
+    # X-Forwarded-For, but only for peers listed in FORWARDED_ALLOW_IPS
+    return sys.intern(request.client.host if request.client else "unknown")
+
+def check_rate_limit(request: Request, limit: int, window_seconds: int, path: str = None) -> bool:
+    ip = _client_ip(request)
+    key = (ip, path or request.url.path, window_seconds)
+    now = time.monotonic()
+    bucket = _rate_store.get(key)
+    if bucket is None:
+        _rate_store[key] = _Bucket(limit - 1, now)
+        if len(_rate_store) > _RATE_STORE_MAX:
+            _rate_store.popitem(last=False)
         return True
-    if entry["count"] >= limit:
+    _rate_store.move_to_end(key)
+    tokens = min(limit, bucket.t + (now - bucket.ts) * (limit / window_seconds))
+    bucket.ts = now
+    if tokens < 1:
+        bucket.t = tokens
         return False
-    entry["count"] += 1
+    bucket.t = tokens - 1
     return True
 
+async def _sweep_rate_store():
+    # A bucket untouched for a full window has refilled and can be dropped
+    while True:
+        await asyncio.sleep(_RATE_SWEEP_INTERVAL)
+        now = time.monotonic()
+        expired = [k for k, b in _rate_store.items() if b.ts + k[2] < now]
+        for k in expired:
+            del _rate_store[k]
+
+_sweeper_task = None
+
+@app.on_event("startup")
+async def start_rate_sweeper():
+    global _sweeper_task
+    _sweeper_task = asyncio.create_task(_sweep_rate_store())
+
+@app.on_event("shutdown")
+async def stop_rate_sweeper():
+    if _sweeper_task is not None:
+        _sweeper_task.cancel()
+
+# Per-route (limit, window_seconds); other paths get the default soft limit
+_ROUTE_LIMITS: Dict[str, Tuple[int, int]] = {
+    "/": (5, 1),
+    "/api/health": (10, 1),
+    "/api/countries": (20, 60),
+    "/api/banners": (60, 60),
+    "/api/verify-recaptcha": (30, 60),
+    "/test": (10, 60),
+}
+_DEFAULT_LIMIT = (120, 60)
+_UNMATCHED_ROUTE = "*"
+
+def _route_template(request: Request) -> str:
+    # Key buckets on the route pattern so path params don't multiply them;
+    # unrouted paths (404s, scanners) all share one bucket per IP. Middleware
+    # runs before routing, so the route is resolved here.
+    for route in app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return _UNMATCHED_ROUTE
+
+# Added before the rate limiter so it sits inside it: BaseHTTPMiddleware
+# re-streams responses, which would defeat GZip's minimum_size if wrapped
+app.add_middleware(GZipMiddleware, minimum_size=512, compresslevel=5)
+
 @app.middleware("http")
 async def rate_limit_middleware(request: Request, call_next):
-    # default soft limit for all routes
-    if not check_rate_limit(request, limit=120, window_seconds=60):
+    path = _route_template(request)
+    limit, window_seconds = _ROUTE_LIMITS.get(path, _DEFAULT_LIMIT)
+    if not check_rate_limit(request, limit=limit, window_seconds=window_seconds, path=path):
         return JSONResponse(status_code=429, content={"detail": "Rate limit exceeded"})
     return await call_next(request)
 
+# Comma-separated list of allowed origins; any origin when unset
+_FRONTEND_ORIGINS = [
+    o.strip() for o in os.getenv("FRONTEND_ORIGIN", "").split(",") if o.strip()
+] or ["*"]
+
+# Added after the rate limiter so it wraps it (429s still get CORS headers)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=_FRONTEND_ORIGINS,
+    allow_credentials=True,
+    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["Content-Type", "Authorization"],
+)
+
 class RecaptchaRequest(BaseModel):
+    model_config = ConfigDict(extra="forbid", frozen=True, str_strip_whitespace=True)
+
     token: str
 
 @app.get("/")
-async def read_root(request: Request):
-    if not check_rate_limit(request, limit=5, window_seconds=1):
-        return JSONResponse(status_code=429, content={"detail": "Rate limit exceeded"})
-    return {"message": "BirthdayDeals Backend Running"}
+async def read_root():
+    return Response(_ROOT_JSON, media_type="application/json")
 
 @app.get("/api/health")
-async def health(request: Request):
-    if not check_rate_limit(request, limit=10, window_seconds=1):
-        return JSONResponse(status_code=429, content={"detail": "Rate limit exceeded"})
-    return {"status": "ok", "countries": list(COUNTRIES.values())}
+async def health():
+    return Response(_HEALTH_JSON, media_type="application/json")
 
 @app.get("/api/countries")
-async def get_countries(request: Request):
-    if not check_rate_limit(request, limit=20, window_seconds=60):
-        return JSONResponse(status_code=429, content={"detail": "Rate limit exceeded"})
-    return list(COUNTRIES.values())
+async def get_countries():
+    return Response(_COUNTRIES_JSON, media_type="application/json")
 
-@app.get("/api/banners")
-async def get_banners(request: Request, country: str):
-    if not check_rate_limit(request, limit=60, window_seconds=60):
-        return JSONResponse(status_code=429, content={"detail": "Rate limit exceeded"})
-    code = country.upper()
-    if code not in COUNTRIES:
+@app.get(
+    "/api/banners",
+    openapi_extra={"parameters": [{
+        "name": "country",
+        "in": "query",
+        "required": True,
+        "schema": {"type": "string", "enum": list(_COUNTRY_LOOKUP)},
+    }]},
+)
+async def get_banners(request: Request):
+    country = request.query_params.get("country")
+    if not country:
+        raise HTTPException(status_code=400, detail="Missing country")
+    code = _COUNTRY_LOOKUP.get(country)
+    if code is None:
         raise HTTPException(status_code=400, detail="Unsupported country")
-    docs = get_documents("banner", {"country_code": code, "is_active": True})
-    docs.sort(key=lambda x: x.get("position", 0))
-    for d in docs:
-        if "_id" in d:
-            d["id"] = str(d.pop("_id"))
-    return docs
+    return await aggregate_documents("banner", [
+        {"$match": {"country_code": code, "is_active": True}},
+        {"$sort": {"position": 1}},
+        {"$project": {
+            "_id": 0,
+            "id": {"$toString": "$_id"},
+            "title": 1,
+            "image_url": 1,
+            "link_url": 1,
+            "position": 1,
+        }},
+    ])
+
+# Cap outstanding calls to Google so a slow upstream can't pile up coroutines
+_RECAPTCHA_TIMEOUT = 3.0
+_recaptcha_sem = asyncio.Semaphore(64)
+# Token checks live in the handler so every rejection is a 400
+_TOKEN_RE = re.compile(r"[A-Za-z0-9_\-]{20,4096}")
+
+async def _post_recaptcha(secret: str, token: str) -> httpx.Response:
+    # Waiting for a slot counts against the caller's timeout too
+    async with _recaptcha_sem:
+        return await _http.post(
+            "https://www.google.com/recaptcha/api/siteverify",
+            data={"secret": secret, "response": token},
+        )
 
 @app.post("/api/verify-recaptcha")
-async def verify_recaptcha(request: Request, payload: RecaptchaRequest):
-    if not check_rate_limit(request, limit=30, window_seconds=60):
-        return JSONResponse(status_code=429, content={"detail": "Rate limit exceeded"})
-    secret = os.getenv("RECAPTCHA_SECRET")
-    if not payload.token:
+async def verify_recaptcha(payload: RecaptchaRequest):
+    tok = payload.token
+    if not tok:
         raise HTTPException(status_code=400, detail="Missing token")
+    if not _TOKEN_RE.fullmatch(tok):
+        raise HTTPException(status_code=400, detail="Invalid token")
+    secret = os.getenv("RECAPTCHA_SECRET")
     if not secret:
         return {"success": False, "skipped": True, "reason": "No secret configured"}
     try:
-        resp = requests.post(
-            "https://www.google.com/recaptcha/api/siteverify",
-            data={"secret": secret, "response": payload.token},
-            timeout=5,
+        resp = await asyncio.wait_for(
+            _post_recaptcha(secret, tok), timeout=_RECAPTCHA_TIMEOUT
         )
         data = resp.json()
         return data
+    except (asyncio.TimeoutError, httpx.TimeoutException):
+        return {"success": False, "skipped": True, "reason": "upstream timeout"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Recaptcha verify failed: {str(e)[:100]}")
 
+# /test is used as a probe; avoid an admin round-trip to Mongo on every hit
+_COLLECTIONS_TTL = 30
+_collections_cache = {"ts": None, "names": []}
+
 @app.get("/test")
-async def test_database(request: Request):
-    if not check_rate_limit(request, limit=10, window_seconds=60):
-        return JSONResponse(status_code=429, content={"detail": "Rate limit exceeded"})
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -128,8 +267,12 @@ async def test_database(request: Request):
             response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
-                response["collections"] = collections[:10]
+                now = time.monotonic()
+                cached_ts = _collections_cache["ts"]
+                if cached_ts is None or now - cached_ts >= _COLLECTIONS_TTL:
+                    _collections_cache["names"] = (await db.list_collection_names())[:10]
+                    _collections_cache["ts"] = now
+                response["collections"] = _collections_cache["names"]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
                 response["database"] = f"⚠️  Connected but Error: {str(e)[:50]}"
@@ -146,4 +289,18 @@ async def test_database(request: Request):
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Rate limits and the reCAPTCHA semaphore are per process, so each extra
+    # worker multiplies them; only scale out when explicitly configured
+    workers = int(os.getenv("WEB_CONCURRENCY", 1))
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        workers=workers,
+        limit_concurrency=1024,
+        backlog=2048,
+        proxy_headers=True,
+        forwarded_allow_ips=os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1"),
+    )
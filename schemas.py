@@ -8,15 +8,20 @@ Countries served: NL (Nederland), AE (Dubai), BH (Bahrein)
 All country-bound documents include a country_code field with one of {"NL","AE","BH"}.
 """
 from typing import Optional, List, Literal
-from pydantic import BaseModel, Field, EmailStr, HttpUrl
+from pydantic import BaseModel, ConfigDict, Field, EmailStr, HttpUrl
 
 CountryCode = Literal["NL", "AE", "BH"]
 
+# Stored documents carry _id/created_at/updated_at, so extra keys are ignored
+_MODEL_CONFIG = ConfigDict(extra="ignore", frozen=True, str_strip_whitespace=True)
+
 class AppUser(BaseModel):
     """
     Users collection schema
     Collection: "appuser"
     """
+    model_config = _MODEL_CONFIG
+
     name: str = Field(..., description="Full name")
     email: EmailStr = Field(..., description="Email address")
     password_hash: str = Field(..., description="Password hash")
@@ -31,6 +36,8 @@ class Company(BaseModel):
     Companies collection schema
     Collection: "company"
     """
+    model_config = _MODEL_CONFIG
+
     name: str
     email: EmailStr
     country_code: CountryCode
@@ -44,6 +51,8 @@ class Deal(BaseModel):
     Deals collection schema
     Collection: "deal"
     """
+    model_config = _MODEL_CONFIG
+
     title: str
     description: str
     country_code: CountryCode
@@ -58,6 +67,8 @@ class Banner(BaseModel):
     Banners collection schema
     Collection: "banner"
     """
+    model_config = _MODEL_CONFIG
+
     title: str
     image_url: HttpUrl
     link_url: Optional[HttpUrl] = None
@@ -70,6 +81,8 @@ class Application(BaseModel):
     Work/Internship applications
     Collection: "application"
     """
+    model_config = _MODEL_CONFIG
+
     full_name: str
     email: EmailStr
     phone: Optional[str] = None
@@ -15,5 +15,7 @@ mkdir -p logs
 echo "Installing dependencies..."
 pip install -r requirements.txt
 echo "Starting FastAPI server..."
+# Development server (auto-reload, single process). For production run
+# `python main.py`, which uses uvloop/httptools and honours WEB_CONCURRENCY.
 nohup uvicorn main:app --host 0.0.0.0 --port 8000 --reload > logs/server.log 2>&1 
 echo "Server started in background"